@@ -1,241 +1,590 @@
-import json
-import re
+from functools import lru_cache
 from io import BytesIO
 from typing import Any, Dict, List, Optional, Tuple
 
+import orjson
 import streamlit as st
-from defusedxml.ElementTree import fromstring  # safer XML parsing
-import xml.etree.ElementTree as ET
+from lxml import etree as LET
+
+# One hardened parser for every upload: no entity expansion, no DTD loading, no network access.
+# Documents that declare entities are rejected by parse_xml() below.
+# Built once at import and reused, so the parser setup is not repeated on every rerun.
+# Sharing it is safe: lxml locks a parser while it parses, so concurrent Streamlit sessions
+# (each script run has its own thread) just take turns.
+_PARSER = LET.XMLParser(
+    resolve_entities=False,
+    no_network=True,
+    load_dtd=False,
+    huge_tree=False,
+    remove_blank_text=False,
+    # ElementTree dropped these too; kept, they would split element text (<ID><!--x-->INV-1</ID>)
+    remove_comments=True,
+    remove_pis=True,
+)
+
+
+def parse_xml(xml_bytes: bytes) -> LET._Element:
+    """
+    Parse one upload with _PARSER.
+    Entity declarations and references are rejected outright (as defusedxml / ElementTree did):
+    with resolve_entities=False lxml would keep &name; references as unresolved nodes and the
+    affected fields would map to None. That includes references left undeclared because they
+    point into an external DTD subset, which is never loaded.
+    Raises LET.XMLSyntaxError for malformed XML, entity declarations or entity references.
+    """
+    root = LET.fromstring(xml_bytes, _PARSER)
+    dtd = root.getroottree().docinfo.internalDTD
+    entities = [e.name for e in dtd.iterentities()] if dtd is not None else []
+    if entities:
+        raise LET.XMLSyntaxError(f"Entity declarations are not allowed: {', '.join(entities)}", 0, 1, 1)
+    ref = next(root.iter(LET.Entity), None)
+    if ref is not None:
+        raise LET.XMLSyntaxError(f"Entity references are not allowed: {ref.text}", 0, ref.sourceline or 1, 1)
+    return root
 
 
 # ----------------------------
 # Helpers: XML pretty print
 # ----------------------------
-def _indent_xml(elem: ET.Element, level: int = 0) -> None:
-    """In-place pretty indentation for ElementTree elements."""
-    i = "\n" + level * "  "
-    if len(elem):
-        if not elem.text or not elem.text.strip():
-            elem.text = i + "  "
-        for child in elem:
-            _indent_xml(child, level + 1)
-        if not elem.tail or not elem.tail.strip():
-            elem.tail = i
-    else:
-        if level and (not elem.tail or not elem.tail.strip()):
-            elem.tail = i
-
-
-def pretty_xml(xml_bytes: bytes) -> str:
-    root = ET.fromstring(xml_bytes)
-    _indent_xml(root)
-    return ET.tostring(root, encoding="unicode")
+def pretty_xml(root: LET._Element) -> str:
+    # pretty_print alone leaves already-indented (or partly indented) input untouched, so
+    # re-indent first. LET.indent only rewrites whitespace-only text/tails, in place and in C.
+    LET.indent(root, space="  ")
+    return LET.tostring(root, encoding="unicode")
 
 
 # ----------------------------
-# Helpers: namespaces + safe find
+# Helpers: namespaces + text
 # ----------------------------
-def extract_namespaces(xml_bytes: bytes) -> Dict[str, str]:
+def extract_namespaces(root: LET._Element) -> Dict[str, str]:
     """
-    Extract namespace mappings from the raw XML using a regex.
+    Collect the namespace declarations seen by the parser.
     Example: xmlns:cbc="urn:oasis:names:specification:..."
+    The default namespace xmlns="..." is reported under "default".
+    For a plain invoice every declaration sits on the root element, so its nsmap is read
+    directly. When the root declares no invoice (UBL/CII) namespace, e.g. an SBDH envelope
+    with the UBL declarations further down, the whole tree is walked (start-ns events).
     """
-    text = xml_bytes.decode("utf-8", errors="replace")
-    ns = dict(re.findall(r'\sxmlns:([A-Za-z0-9_]+)="([^"]+)"', text))
-    # also handle default namespace xmlns="..."
-    m = re.search(r'\sxmlns="([^"]+)"', text)
-    if m:
-        ns["default"] = m.group(1)
+    ns = {prefix or "default": uri for prefix, uri in root.nsmap.items()}
+    if detect_dialect(ns) != "fallback":
+        return ns
+    for _, (prefix, uri) in LET.iterwalk(root, events=("start-ns",)):
+        ns[prefix or "default"] = uri
     return ns
 
 
-def text_or_none(elem: Optional[ET.Element]) -> Optional[str]:
+def text_or_none(elem: Optional[LET._Element]) -> Optional[str]:
     if elem is None:
         return None
     t = (elem.text or "").strip()
     return t if t else None
 
 
-def find_first_text(root: ET.Element, paths: List[str], ns: Dict[str, str]) -> Optional[str]:
-    for p in paths:
-        e = root.find(p, ns)
-        t = text_or_none(e)
-        if t is not None:
-            return t
-    return None
-
-
-def find_all_text(root: ET.Element, path: str, ns: Dict[str, str]) -> List[str]:
-    out = []
-    for e in root.findall(path, ns):
-        t = text_or_none(e)
-        if t is not None:
-            out.append(t)
-    return out
-
-
 # ----------------------------
 # Generic XML -> dict (fallback)
 # ----------------------------
+@lru_cache(maxsize=4096)
 def strip_ns(tag: str) -> str:
-    return tag.split("}", 1)[-1] if "}" in tag else tag
+    # Tags repeat heavily within a document, so the cache hit rate is close to 100%.
+    i = tag.find("}")
+    return tag if i < 0 else tag[i + 1 :]
 
 
-def xml_to_dict(elem: ET.Element) -> Dict[str, Any]:
+def xml_to_dict(elem: LET._Element) -> Dict[str, Any]:
     """
     Convert XML to a nested dict:
     - attributes under "@attrs"
     - repeated child tags become lists
     - leaf text under "#text" if attributes exist, else plain string
+    The traversal itself runs in C (lxml iterwalk start/end events); Python only builds the
+    values, post-order, on an explicit stack.
     """
-    node: Dict[str, Any] = {}
-    attrs = {k: v for k, v in elem.attrib.items()} if elem.attrib else {}
-    children = list(elem)
-
-    # Process children
-    if children:
-        grouped: Dict[str, List[Any]] = {}
-        for c in children:
-            k = strip_ns(c.tag)
-            grouped.setdefault(k, []).append(xml_to_dict(c))
-        for k, v in grouped.items():
-            node[k] = v[0] if len(v) == 1 else v
-
-    # Text
-    text = (elem.text or "").strip()
-    if text:
-        if node or attrs:
-            node["#text"] = text
+    # One entry per open element: its grouped child results, or None until it has a child.
+    # tag=LET.Element restricts the walk to elements: iterwalk already skips comments and
+    # processing instructions, but would otherwise yield entity references.
+    stack: List[Optional[Dict[str, List[Any]]]] = []
+    result: Dict[str, Any] = {}
+    # Local tag -> local-name map: a dict lookup is cheaper than even a cached function call.
+    # Keyed on the tag string itself: lxml builds a separate str per element, so id(tag) would miss.
+    local_names: Dict[str, str] = {}
+    for event, e in LET.iterwalk(elem, events=("start", "end"), tag=LET.Element):
+        if event == "start":
+            stack.append(None)
+            continue
+        grouped = stack.pop()
+        qtag = e.tag
+        tag = local_names.get(qtag)
+        if tag is None:
+            tag = local_names[qtag] = strip_ns(qtag)
+        node: Dict[str, Any] = {}
+        # Most nodes have no attributes: only copy (C-level dict()) when there is something to copy
+        attrib = e.attrib
+        attrs = dict(attrib) if attrib else None
+
+        # Children
+        if grouped:
+            for k, v in grouped.items():
+                node[k] = v[0] if len(v) == 1 else v
+
+        # Text
+        text = (e.text or "").strip()
+        if text and not node and attrs is None:
+            value: Dict[str, Any] = {tag: text}
+        else:
+            if text:
+                node["#text"] = text
+            # Attributes
+            if attrs is not None:
+                node["@attrs"] = attrs
+            value = {tag: node if node else (text if text else {})}
+
+        if not stack:
+            result = value
+        else:
+            parent = stack[-1]
+            if parent is None:
+                parent = stack[-1] = {}
+            siblings = parent.get(tag)
+            if siblings is None:
+                parent[tag] = [value]
+            else:
+                siblings.append(value)
+    return result
+
+
+# ----------------------------
+# Single-pass field scan
+# One walk over the tree collects every candidate value, SAX-style: lxml filters the
+# walk down to the target and context tags in C, so Python only sees events for those.
+# Elements are dispatched on their local name; a stack of the open context tags tells
+# supplier vs customer party, the current invoice line, ... apart.
+# ----------------------------
+_PARTY_TAGS = {
+    "AccountingSupplierParty",
+    "SellerSupplierParty",
+    "SellerTradeParty",  # some CII/XRechnung-ish structures
+    "AccountingCustomerParty",
+    "BuyerTradeParty",
+}
+
+
+def _set_first(state: Dict[str, Any], elem: LET._Element, stack: List[str]) -> None:
+    t = text_or_none(elem)
+    if t is not None:
+        state["first"].setdefault(stack[-1], t)
+
+
+def _parent_name(elem: LET._Element) -> Optional[str]:
+    # The stack only holds filtered tags, so the real parent comes from the tree.
+    parent = elem.getparent()
+    return strip_ns(parent.tag) if parent is not None else None
+
+
+def _maybe_id(state: Dict[str, Any], elem: LET._Element, stack: List[str]) -> None:
+    t = text_or_none(elem)
+    if t is None:
+        return
+    parent = elem.getparent()
+    line = state["line"]
+    if line is not None and strip_ns(parent.tag) == "InvoiceLine":
+        if line["lineId"] is None:
+            line["lineId"] = t
+        return
+    if parent is not None and parent.getparent() is None:  # direct child of the document root
+        state["first"].setdefault("rootID", t)
+    state["first"].setdefault("ID", t)
+
+
+def _set_payable(state: Dict[str, Any], elem: LET._Element, stack: List[str]) -> None:
+    if "payableAttrs" not in state:
+        state["payableAttrs"] = elem.attrib
+    _set_first(state, elem, stack)
+
+
+def _set_name(state: Dict[str, Any], elem: LET._Element, stack: List[str]) -> None:
+    t = text_or_none(elem)
+    if t is None:
+        return
+    for i in range(len(stack) - 2, -1, -1):
+        party = stack[i]
+        if party in _PARTY_TAGS:
+            names = state["names"]
+            names.setdefault(party, t)
+            if "PartyName" in stack[i + 1 :]:
+                names.setdefault(party + "/PartyName", t)
+            return
+
+
+def _set_description(state: Dict[str, Any], elem: LET._Element, stack: List[str]) -> None:
+    line = state["line"]
+    if line is not None and line["description"] is None and _parent_name(elem) == "Item":
+        line["description"] = text_or_none(elem)
+
+
+def _set_quantity(state: Dict[str, Any], elem: LET._Element, stack: List[str]) -> None:
+    line = state["line"]
+    if line is not None and line["quantity"] is None:
+        line["quantity"] = text_or_none(elem)
+
+
+def _open_line(state: Dict[str, Any], elem: LET._Element, stack: List[str]) -> None:
+    state["line"] = {"lineId": None, "description": None, "quantity": None}
+
+
+def _push_line(state: Dict[str, Any], elem: LET._Element, stack: List[str]) -> None:
+    state["lines"].append(state["line"])
+    state["line"] = None
+
+
+_START_HANDLERS = {
+    "InvoiceLine": _open_line,
+}
+
+_END_HANDLERS = {
+    "ID": _maybe_id,
+    "IssueDate": _set_first,
+    "IssueDateTime": _set_first,
+    "DueDate": _set_first,
+    "DocumentCurrencyCode": _set_first,
+    "TaxCurrencyCode": _set_first,
+    "PayableAmount": _set_payable,
+    "TaxInclusiveAmount": _set_first,
+    "Name": _set_name,
+    "Description": _set_description,
+    "InvoicedQuantity": _set_quantity,
+    "InvoiceLine": _push_line,
+}
+
+
+# Tags that carry no value themselves but give context to the ones below them
+_CONTEXT_TAGS = _PARTY_TAGS | {"PartyName"}
+
+# "{*}" matches the local name in any namespace, including none. The patterns only match
+# elements, so entity references (kept by _PARSER if ever let through) never reach strip_ns.
+_SCAN_TAGS = ["{*}" + t for t in sorted(_CONTEXT_TAGS | set(_START_HANDLERS) | set(_END_HANDLERS))]
+
+
+def scan(root: LET._Element) -> Dict[str, Any]:
+    state: Dict[str, Any] = {"first": {}, "names": {}, "lines": [], "line": None}
+    stack: List[str] = []
+    for event, elem in LET.iterwalk(root, events=("start", "end"), tag=_SCAN_TAGS):
+        if event == "start":
+            local = strip_ns(elem.tag)
+            stack.append(local)
+            handler = _START_HANDLERS.get(local)
         else:
-            return {strip_ns(elem.tag): text}
+            handler = _END_HANDLERS.get(stack[-1])
+        if handler is not None:
+            handler(state, elem, stack)
+        if event == "end":
+            stack.pop()
+    return state
+
+
+def _pick(values: Dict[str, str], *keys: str) -> Optional[str]:
+    for k in keys:
+        v = values.get(k)
+        if v is not None:
+            return v
+    return None
+
+
+def fields_from_scan(root: LET._Element) -> Dict[str, Any]:
+    # Matching is on local names, so prefixed (cbc/cac) and un-prefixed documents
+    # go through the same "best effort" lookups.
+    state = scan(root)
+    first = state["first"]
+    names = state["names"]
 
-    # Attributes
-    if attrs:
-        node["@attrs"] = attrs
+    payable_amount_currency = None
+    # Try to read the currency attribute for PayableAmount if present
+    pay_attrs = state.get("payableAttrs")
+    if pay_attrs is not None:
+        payable_amount_currency = pay_attrs.get("currencyID") or pay_attrs.get("currencyId")
 
-    return {strip_ns(elem.tag): node if node else (text if text else {})}
+    return {
+        "invoiceNumber": _pick(first, "rootID", "ID"),
+        "issueDate": _pick(first, "IssueDate", "IssueDateTime"),
+        "dueDate": _pick(first, "DueDate"),
+        "currency": _pick(first, "DocumentCurrencyCode", "TaxCurrencyCode"),
+        # Supplier / Customer names (common in UBL)
+        "supplierName": _pick(
+            names,
+            "AccountingSupplierParty/PartyName",
+            "SellerSupplierParty/PartyName",
+            "SellerTradeParty",
+            "AccountingSupplierParty",
+        ),
+        "customerName": _pick(
+            names,
+            "AccountingCustomerParty/PartyName",
+            "BuyerTradeParty",
+            "AccountingCustomerParty",
+        ),
+        "payableAmount": _pick(first, "PayableAmount", "TaxInclusiveAmount"),
+        "payableAmountCurrency": payable_amount_currency,
+        # Invoice lines (best effort), built per line as each InvoiceLine closes
+        "lines": state["lines"],
+    }
 
 
 # ----------------------------
-# Simple "common invoice fields" mapper
-# Works for many UBL/XRechnung variants; if not found, returns what it can.
+# Precompiled UBL XPaths
+# Bound to the standard UBL namespace URIs, so they work whatever prefixes the
+# document itself uses and are compiled once per process instead of per upload.
 # ----------------------------
-def map_invoice_common(root: ET.Element, ns: Dict[str, str]) -> Dict[str, Any]:
-    # UBL/XRechnung common namespaces are often cbc/cac
-    # We'll use "best effort" paths.
-    invoice_id = find_first_text(
-        root,
-        paths=[
-            ".//cbc:ID",
-            ".//ID",  # fallback if no ns prefixes
-        ],
-        ns=ns,
-    )
+UBL_NS = {
+    "cbc": "urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2",
+    "cac": "urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2",
+}
+
+
+def _ubl_xpaths(*paths: str) -> List[LET.XPath]:
+    return [LET.XPath(p, namespaces=UBL_NS) for p in paths]
+
+
+# Paths are relative to the UBL document element and follow the schema's fixed nesting on
+# the child axis, so a lookup only touches the few elements on its path instead of walking
+# the whole document. Each step is first-match (step[1]) so libxml2 stops at the first hit.
+# Variants stay separate, in priority order, because a union is evaluated branch by branch
+# in full and would never save a walk.
+_UBL_FIELDS = {
+    "invoiceNumber": _ubl_xpaths("cbc:ID[1]"),
+    "issueDate": _ubl_xpaths("cbc:IssueDate[1]", "cbc:IssueDateTime[1]"),
+    "dueDate": _ubl_xpaths("cbc:DueDate[1]"),
+    "currency": _ubl_xpaths("cbc:DocumentCurrencyCode[1]", "cbc:TaxCurrencyCode[1]"),
+    "supplierName": _ubl_xpaths(
+        "cac:AccountingSupplierParty[1]/cac:Party[1]/cac:PartyName[1]/cbc:Name[1]",
+        "cac:SellerSupplierParty[1]/cac:Party[1]/cac:PartyName[1]/cbc:Name[1]",
+        "cac:AccountingSupplierParty[1]/descendant::cbc:Name[1]",
+    ),
+    "customerName": _ubl_xpaths(
+        "cac:AccountingCustomerParty[1]/cac:Party[1]/cac:PartyName[1]/cbc:Name[1]",
+        "cac:AccountingCustomerParty[1]/descendant::cbc:Name[1]",
+    ),
+}
+_UBL_PAYABLE = _ubl_xpaths(
+    "cac:LegalMonetaryTotal[1]/cbc:PayableAmount[1]",
+    "cac:LegalMonetaryTotal[1]/cbc:TaxInclusiveAmount[1]",
+)
+_UBL_LINES = LET.XPath("cac:InvoiceLine", namespaces=UBL_NS)
+
+# Qualified tags of the InvoiceLine children read per line
+_UBL_LINE_ID = "{%s}ID" % UBL_NS["cbc"]
+_UBL_LINE_QTY = "{%s}InvoicedQuantity" % UBL_NS["cbc"]
+_UBL_LINE_ITEM = "{%s}Item" % UBL_NS["cac"]
+_UBL_ITEM_DESC = "{%s}Description" % UBL_NS["cbc"]
+
+# Document-level UBL elements (Invoice-2, CreditNote-2, ...) live in their own namespaces
+# under this common prefix. The component namespaces share the prefix but never hold a
+# document element, so they are excluded.
+_UBL_TAG_PREFIX = "{urn:oasis:names:specification:ubl:schema:xsd:"
+_UBL_COMPONENT_PREFIXES = tuple(
+    _UBL_TAG_PREFIX + name + "}"
+    for name in ("CommonBasicComponents-2", "CommonAggregateComponents-2", "CommonExtensionComponents-2")
+)
 
-    issue_date = find_first_text(
-        root,
-        paths=[
-            ".//cbc:IssueDate",
-            ".//IssueDate",
-            ".//cbc:IssueDateTime",
-        ],
-        ns=ns,
-    )
 
-    due_date = find_first_text(
-        root,
-        paths=[
-            ".//cbc:DueDate",
-            ".//DueDate",
-        ],
-        ns=ns,
-    )
+def _is_ubl_document_tag(tag: Any) -> bool:
+    return isinstance(tag, str) and tag.startswith(_UBL_TAG_PREFIX) and not tag.startswith(_UBL_COMPONENT_PREFIXES)
 
-    # Supplier / Customer names (common in UBL)
-    supplier_name = find_first_text(
-        root,
-        paths=[
-            ".//cac:AccountingSupplierParty//cac:Party//cac:PartyName//cbc:Name",
-            ".//cac:SellerSupplierParty//cac:Party//cac:PartyName//cbc:Name",
-            ".//SellerTradeParty//Name",  # some CII/XRechnung-ish structures
-            ".//cac:AccountingSupplierParty//cbc:Name",
-        ],
-        ns=ns,
-    )
 
-    customer_name = find_first_text(
-        root,
-        paths=[
-            ".//cac:AccountingCustomerParty//cac:Party//cac:PartyName//cbc:Name",
-            ".//BuyerTradeParty//Name",
-            ".//cac:AccountingCustomerParty//cbc:Name",
-        ],
-        ns=ns,
-    )
+def _ubl_document(root: LET._Element) -> LET._Element:
+    # Usually the root itself; envelopes (e.g. a business-document header wrapping the
+    # invoice) are handled by taking the first element in a document-level UBL namespace.
+    if _is_ubl_document_tag(root.tag):
+        return root
+    for elem in root.iter(LET.Element):
+        if _is_ubl_document_tag(elem.tag):
+            return elem
+    return root
 
-    currency = find_first_text(
-        root,
-        paths=[
-            ".//cbc:DocumentCurrencyCode",
-            ".//DocumentCurrencyCode",
-            ".//cbc:TaxCurrencyCode",
-        ],
-        ns=ns,
-    )
 
-    payable_amount = find_first_text(
-        root,
-        paths=[
-            ".//cbc:PayableAmount",
-            ".//PayableAmount",
-            ".//cbc:TaxInclusiveAmount",
-        ],
-        ns=ns,
-    )
+def find_first(elem: LET._Element, xpaths: List[LET.XPath]) -> Optional[LET._Element]:
+    # First match with non-empty text, like find_first_text: an empty element falls through to
+    # the next variant, and callers still read its attributes from the element that won.
+    for xp in xpaths:
+        res = xp(elem)
+        if res and text_or_none(res[0]) is not None:
+            return res[0]
+    return None
 
-    payable_amount_currency = None
-    # Try to read the currency attribute for PayableAmount if present
-    pay_elem = root.find(".//cbc:PayableAmount", ns) or root.find(".//PayableAmount", ns)
-    if pay_elem is not None:
-        payable_amount_currency = pay_elem.attrib.get("currencyID") or pay_elem.attrib.get("currencyId")
-
-    # Invoice lines (best effort)
-    line_ids = find_all_text(root, ".//cac:InvoiceLine//cbc:ID", ns) or find_all_text(root, ".//InvoiceLine//ID", ns)
-    line_descs = find_all_text(root, ".//cac:InvoiceLine//cac:Item//cbc:Description", ns)
-    line_qtys = find_all_text(root, ".//cac:InvoiceLine//cbc:InvoicedQuantity", ns)
-
-    lines: List[Dict[str, Any]] = []
-    max_len = max(len(line_ids), len(line_descs), len(line_qtys), 0)
-    for i in range(max_len):
-        lines.append(
-            {
-                "lineId": line_ids[i] if i < len(line_ids) else None,
-                "description": line_descs[i] if i < len(line_descs) else None,
-                "quantity": line_qtys[i] if i < len(line_qtys) else None,
-            }
-        )
+
+def find_first_text(elem: LET._Element, xpaths: List[LET.XPath]) -> Optional[str]:
+    for xp in xpaths:
+        res = xp(elem)
+        t = text_or_none(res[0]) if res else None
+        if t is not None:
+            return t
+    return None
+
+
+def _ubl_line(line: LET._Element) -> Dict[str, Any]:
+    # One pass over the line's direct children (plain tag compares) instead of an XPath
+    # evaluation per field; every value comes from this line, so fields can't shift between lines.
+    out: Dict[str, Any] = {"lineId": None, "description": None, "quantity": None}
+    for child in line:
+        tag = child.tag
+        if tag == _UBL_LINE_ID:
+            if out["lineId"] is None:
+                out["lineId"] = text_or_none(child)
+        elif tag == _UBL_LINE_QTY:
+            if out["quantity"] is None:
+                out["quantity"] = text_or_none(child)
+        elif tag == _UBL_LINE_ITEM and out["description"] is None:
+            out["description"] = text_or_none(next(child.iterchildren(_UBL_ITEM_DESC), None))
+    return out
+
+
+def fields_from_ubl(root: LET._Element) -> Dict[str, Any]:
+    doc = _ubl_document(root)
+    fields: Dict[str, Any] = {k: find_first_text(doc, xps) for k, xps in _UBL_FIELDS.items()}
+
+    pay = find_first(doc, _UBL_PAYABLE)
+    fields["payableAmount"] = text_or_none(pay)
+    fields["payableAmountCurrency"] = (pay.get("currencyID") or pay.get("currencyId")) if pay is not None else None
+
+    fields["lines"] = [_ubl_line(line) for line in _UBL_LINES(doc)]
+    return fields
+
+
+# ----------------------------
+# Precompiled CII XPaths (ZUGFeRD / Factur-X / XRechnung CII)
+# Same approach as UBL: standard namespace URIs, child-axis paths from the
+# rsm:CrossIndustryInvoice root, first-match steps, variants in priority order.
+# ----------------------------
+CII_NS = {
+    "rsm": "urn:un:unece:uncefact:data:standard:CrossIndustryInvoice:100",
+    "ram": "urn:un:unece:uncefact:data:standard:ReusableAggregateBusinessInformationEntity:100",
+    "udt": "urn:un:unece:uncefact:data:standard:UnqualifiedDataType:100",
+}
+
+
+def _cii_xpaths(*paths: str) -> List[LET.XPath]:
+    return [LET.XPath(p, namespaces=CII_NS) for p in paths]
+
+
+_CII_TX = "rsm:SupplyChainTradeTransaction[1]"
+_CII_AGREEMENT = _CII_TX + "/ram:ApplicableHeaderTradeAgreement[1]"
+_CII_SETTLEMENT = _CII_TX + "/ram:ApplicableHeaderTradeSettlement[1]"
+_CII_SUMMATION = _CII_SETTLEMENT + "/ram:SpecifiedTradeSettlementHeaderMonetarySummation[1]"
+
+_CII_FIELDS = {
+    "invoiceNumber": _cii_xpaths("rsm:ExchangedDocument[1]/ram:ID[1]"),
+    "issueDate": _cii_xpaths("rsm:ExchangedDocument[1]/ram:IssueDateTime[1]/udt:DateTimeString[1]"),
+    "dueDate": _cii_xpaths(
+        _CII_SETTLEMENT + "/ram:SpecifiedTradePaymentTerms[1]/ram:DueDateDateTime[1]/udt:DateTimeString[1]"
+    ),
+    "currency": _cii_xpaths(
+        _CII_SETTLEMENT + "/ram:InvoiceCurrencyCode[1]",
+        _CII_SETTLEMENT + "/ram:TaxCurrencyCode[1]",
+    ),
+    "supplierName": _cii_xpaths(_CII_AGREEMENT + "/ram:SellerTradeParty[1]/ram:Name[1]"),
+    "customerName": _cii_xpaths(_CII_AGREEMENT + "/ram:BuyerTradeParty[1]/ram:Name[1]"),
+}
+_CII_PAYABLE = _cii_xpaths(
+    _CII_SUMMATION + "/ram:DuePayableAmount[1]",
+    _CII_SUMMATION + "/ram:GrandTotalAmount[1]",
+)
+_CII_LINES = LET.XPath(_CII_TX + "/ram:IncludedSupplyChainTradeLineItem", namespaces=CII_NS)
+_CII_LINE_FIELDS = {
+    "lineId": _cii_xpaths("ram:AssociatedDocumentLineDocument[1]/ram:LineID[1]"),
+    "description": _cii_xpaths("ram:SpecifiedTradeProduct[1]/ram:Description[1]"),
+    "quantity": _cii_xpaths("ram:SpecifiedLineTradeDelivery[1]/ram:BilledQuantity[1]"),
+}
+
+
+def fields_from_cii(root: LET._Element) -> Dict[str, Any]:
+    fields: Dict[str, Any] = {k: find_first_text(root, xps) for k, xps in _CII_FIELDS.items()}
+
+    pay = find_first(root, _CII_PAYABLE)
+    fields["payableAmount"] = text_or_none(pay)
+    fields["payableAmountCurrency"] = (pay.get("currencyID") or pay.get("currencyId")) if pay is not None else None
+
+    fields["lines"] = [
+        {k: find_first_text(line, xps) for k, xps in _CII_LINE_FIELDS.items()} for line in _CII_LINES(root)
+    ]
+    return fields
+
+
+# ----------------------------
+# Simple "common invoice fields" mapper
+# Works for many UBL/XRechnung/CII variants; if not found, returns what it can.
+# ----------------------------
+def detect_dialect(ns: Dict[str, str]) -> str:
+    # Decided on namespace URIs, not prefixes: documents are free to pick their own prefixes.
+    # Only the UBL 2.x component namespaces select the UBL mapper (its XPaths are bound to them);
+    # other UBL versions go through the generic scan.
+    uris = ns.values()
+    if UBL_NS["cbc"] in uris or UBL_NS["cac"] in uris:
+        return "ubl"
+    if CII_NS["rsm"] in uris:
+        return "cii"
+    return "fallback"
+
+
+# Each dialect only runs the lookups that can match its schema; anything unrecognised
+# goes through the namespace-agnostic single-pass scan.
+_MAPPERS = {
+    "ubl": fields_from_ubl,
+    "cii": fields_from_cii,
+    "fallback": fields_from_scan,
+}
+
+
+def map_invoice_common(root: LET._Element, ns: Dict[str, str]) -> Dict[str, Any]:
+    dialect = detect_dialect(ns)
+    fields = _MAPPERS[dialect](root)
 
     return {
         "documentType": "invoice",
-        "invoiceNumber": invoice_id,
-        "issueDate": issue_date,
-        "dueDate": due_date,
-        "currency": currency,
-        "supplier": {"name": supplier_name},
-        "customer": {"name": customer_name},
+        "invoiceNumber": fields["invoiceNumber"],
+        "issueDate": fields["issueDate"],
+        "dueDate": fields["dueDate"],
+        "currency": fields["currency"],
+        "supplier": {"name": fields["supplierName"]},
+        "customer": {"name": fields["customerName"]},
         "totals": {
-            "payableAmount": payable_amount,
-            "payableAmountCurrency": payable_amount_currency or currency,
+            "payableAmount": fields["payableAmount"],
+            "payableAmountCurrency": fields["payableAmountCurrency"] or fields["currency"],
         },
-        "lines": lines,
+        "lines": fields["lines"],
         "meta": {
             "rootTag": strip_ns(root.tag),
+            "dialect": dialect,
             "namespacesDetected": list(ns.keys()),
-            "mappingNote": "Best-effort common-field mapping; for full fidelity use xmlAsJsonFallback.",
+            "mappingNote": "Best-effort common-field mapping; for full fidelity include xmlAsJsonFallback.",
         },
     }
 
 
+# ----------------------------
+# Full pipeline for one upload
+# ----------------------------
+@st.cache_data(show_spinner=False, max_entries=32)
+def process(xml_bytes: bytes, include_fallback: bool) -> Tuple[str, bytes, Dict[str, str]]:
+    """
+    Parse, map and serialize one upload: returns (pretty XML, mapped JSON bytes, namespaces).
+    Cached on the uploaded bytes, so reruns (tab switches, downloads, ...) reuse the result;
+    max_entries bounds the cache so a long-running multi-user server doesn't grow without limit.
+    Raises LET.XMLSyntaxError for malformed XML.
+    """
+    # Parse safely (entity declarations rejected; DTD loading and network access disabled)
+    root = parse_xml(xml_bytes)
+    ns = extract_namespaces(root)
+
+    mapped_common = map_invoice_common(root, ns)
+
+    # Full fallback representation (opt-in: it is as large as the document itself)
+    if include_fallback:
+        mapped_common["xmlAsJsonFallback"] = xml_to_dict(root)
+
+    pretty_xml_text = pretty_xml(root)
+    # orjson serializes straight to UTF-8 bytes: download them as-is, decode once for display
+    pretty_json_bytes = orjson.dumps(mapped_common, option=orjson.OPT_INDENT_2)
+    return pretty_xml_text, pretty_json_bytes, ns
+
+
 # ----------------------------
 # Streamlit UI
 # ----------------------------
@@ -253,30 +602,15 @@ if not uploaded:
 
 xml_bytes = uploaded.read()
 
-# Parse safely
+include_fallback = st.checkbox("Include full XML→JSON fallback (xmlAsJsonFallback)", value=False)
+
 try:
-    safe_root = fromstring(xml_bytes)  # defusedxml
-    # Convert defusedxml Element -> ElementTree compatible by re-parsing with ET for pretty + xpath
-    root = ET.fromstring(xml_bytes)
-except Exception as e:
+    pretty_xml_text, pretty_json_bytes, ns = process(xml_bytes, include_fallback)
+except LET.XMLSyntaxError as e:
     st.error(f"Could not parse XML: {e}")
     st.stop()
 
-ns = extract_namespaces(xml_bytes)
-
-# ElementTree expects prefixes to be registered in the namespace dict you pass to find/findall.
-# If there is a default namespace, XPath with prefixes won't match it. We'll just keep prefixes we found.
-# Common UBL prefixes are cbc/cac; if missing, many queries will fall back to non-namespaced paths.
-# No further action needed.
-
-mapped_common = map_invoice_common(root, ns)
-
-# Full fallback representation (so you always have something to copy)
-xml_as_dict = xml_to_dict(root)
-mapped_common["xmlAsJsonFallback"] = xml_as_dict
-
-pretty_xml_text = pretty_xml(xml_bytes)
-pretty_json_text = json.dumps(mapped_common, indent=2, ensure_ascii=False)
+pretty_json_text = pretty_json_bytes.decode("utf-8")
 
 tab1, tab2 = st.tabs(["XML", "Mapped JSON"])
 
@@ -297,7 +631,7 @@ with tab2:
 
     st.download_button(
         "Download JSON",
-        data=pretty_json_text.encode("utf-8"),
+        data=pretty_json_bytes,
         file_name="mapped.json",
         mime="application/json",
     )
@@ -305,4 +639,4 @@ with tab2:
 with st.expander("Debug: namespaces detected"):
     st.json(ns)
 
-st.caption("Note: Mapping is best-effort. The JSON always includes a full XML→JSON fallback under xmlAsJsonFallback.")
+st.caption("Note: Mapping is best-effort. Tick the fallback option to include a full XML→JSON conversion under xmlAsJsonFallback.")